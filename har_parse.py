@@ -9,12 +9,26 @@
 
 
 import simplejson       # JSON parse library
+# orjson is much quicker on large HAR files so use it when it is installed,
+# simplejson is still needed for the files orjson is stricter about
+try:
+    import orjson
+except ImportError:
+    orjson = None
+# ijson lets us stream parse very large HAR files, used if installed
+try:
+    import ijson
+except ImportError:
+    ijson = None
 import sys              # basic system calls 
-import hashlib          # calculate MD5 hashes
+import hashlib          # calculate BLAKE2 hashes
 import pprint           # pretty print
 import colorama         # I want colour output!
 import re               # regular expression library
 import datetime         # format dates and time
+import base64           # decode base64 encoded response bodies
+import concurrent.futures   # read and parse both HAR files at the same time
+import os               # file sizes
 
 # set debug mode, set to '1' if things are not going well!
 debug = 0
@@ -36,20 +50,112 @@ summary_log_string = log_timestamp
 log_filename = "harparse_log.txt"
 summary_filename = "harparse_summary.txt"
 
+# HAR files bigger than this (in bytes) are stream parsed one entry at a
+# time, rather than loaded into memory in one go, if ijson is installed
+stream_threshold = 64 * 1024 * 1024
+
+# number of threads used to hash the JavaScript bodies of a HAR file
+hash_workers = os.cpu_count() or 1
+
 # globals for ANSI color changes and initialise ANSI output
 colorama.init()
 RED = '\033[31m'   # mode 31 = red forground
 GREEN = '\033[32m' # mode 32 = green foreground
 RESET = '\033[0m'  # mode 0  = reset
 
+# regular expressions used while parsing, compiled once here rather than
+# on every HAR entry
+_VERSION_RE = re.compile(r'/version\d+/')                   # Magento version dir
+_V_RE = re.compile(r'/v\d+/')                               # Demandware version dir
+
+# content types (ignoring any parameters such as charset) that mean
+# a response is JavaScript
+_JS_CTYPES = frozenset((
+    'application/javascript', 'application/x-javascript',
+    'application/ecmascript', 'application/x-ecmascript',
+    'text/javascript', 'text/x-javascript',
+    'text/ecmascript', 'text/x-ecmascript',
+))
+
+# header names we look up, interned (as are the names in headerDict) so
+# dictionary lookups can match on identity rather than comparing strings
+CONTENT_TYPE = sys.intern('content-type')
+REFERER = sys.intern('referer')
+
+# large response bodies are encoded for hashing this many characters at a time
+HASH_CHUNK = 1 << 20
+
 # define a function to add to the log_lines in case
-# we want to write the log file entries, this makes the
-# log lines consistant in case of future searching etc.
+# we want to write the log file entries, the timestamp is
+# added to every line when the log file is written, this
+# makes the log lines consistant in case of future searching etc.
 def writeLog(new_line):
-    log_lines.append(log_timestamp + new_line)
+    log_lines.append(new_line)
+
+# function redactQstring will replace the query string of a URL (if any)
+# with a placeholder, a plain partition is much cheaper than a regex here
+
+def redactQstring(url):
+    head, sep, tail = url.partition('?')
+    if sep and tail:
+        return head + '[qstring redacted]'
+    return url
+
+# function hashContent will feed the body of a HAR content record into the
+# hash object m, base64 bodies are decoded straight into the hash and text
+# bodies are encoded a chunk at a time rather than copied in one go
+
+def hashContent(m, content):
+    text = content['text']
+    if content.get('encoding') == 'base64':
+        try:
+            m.update(base64.b64decode(text))
+            return
+        except ValueError:
+            # not really base64 after all, hash it as text instead
+            pass
+    for i in range(0, len(text), HASH_CHUNK):
+        m.update(text[i:i + HASH_CHUNK].encode('utf-8', 'surrogatepass'))
+
+# function hashBody will return the hex digest for a HAR content record,
+# we are using hashes for change detection not signing etc. so a 128 bit
+# BLAKE2b digest is plenty and is quicker than MD5 on large bodies
+
+def hashBody(content):
+    m = hashlib.blake2b(digest_size=16)
+    if not 'text' in content:
+        # hash a placeholder rather than add it to the HAR itself
+        m.update(b"ADDED TEXT TO ANOMOLY")
+    else:
+        hashContent(m, content)
+    return m.hexdigest()
+
+# function headerDict will turn a HAR list of {name, value} headers into
+# a dictionary keyed on the lower case header name, so a header can be
+# found with one lookup (if a header is repeated the last one wins), the
+# names are interned as the same few names appear in every entry
+
+def headerDict(headers):
+    return {sys.intern(header['name'].lower()) : header['value'] for header in headers}
+
+# function indexHeaders will add header dictionaries (see headerDict) to a
+# HAR entry when it is loaded, '_rh' for the response and '_qh' for the
+# request, so getJS only ever needs a dictionary lookup to find a header
+
+def indexHeaders(entry):
+    entry['_rh'] = headerDict(entry['response']['headers'])
+    entry['_qh'] = headerDict(entry['request']['headers'])
+    return entry
+
+# function isJavaScript will check a content-type header value against the
+# JavaScript content types, only the type itself is compared, not the
+# parameters after any ';'
+
+def isJavaScript(content_type):
+    return content_type.partition(';')[0].strip().lower() in _JS_CTYPES
 
 # function getJS will process .har file and return a dictionary mapping
-# JS file URLs to {size, hash, content} records (as dicts)
+# JS file URLs to {size, hash, referer} records (as dicts)
 
 def getJS(outerDict, debug):
     
@@ -60,97 +166,160 @@ def getJS(outerDict, debug):
     file_details['title'] = outerDict['log']['pages'][0]['title']
     file_details['startedDateTime'] = outerDict['log']['pages'][0]['startedDateTime']
 
-     # the domain needs to be detected so we need a Regex
-    domain = re.compile('^(https://[^/]+)', re.IGNORECASE)
+    # the domain needs to be detected, it is everything up to the first
+    # '/' after the scheme if the title is an https URL
     page_domain = ""
-    find_domain = re.match(domain, file_details['title'])
-    if find_domain:
-        page_domain = find_domain.group(1)
-        print ("Page domain is " + page_domain)
-
-
-    all_entries_array = outerDict['log']['entries']
-    for entry in all_entries_array:
-        # we will need to calculate hashes, note that MD5 is not a secure
-        # hash and we are using it for change detection not signing etc.
-        m = hashlib.md5()
-        
-        url = entry['request']['url']
-        # we need to remove the query string from any URL
-        # because they are often extemely long and reduce readability
-        url = re.sub('\?.+$', '[qstring redacted]', url)
-
-        # check for external vs internal domain
-        if url.find(page_domain):
-            # print (url + " is external")
-            pass
-        else:
-            # print (url + " is internal")
-            # we have an internal JS path so ignore the version number
-            # if this is a Magento system, other content platforms
-            # can be dealt with in a similar manner but if used 
-            # regularly we should problem extract this to a config file
-            url = re.sub('/version\d+/', '/version9999999999/',url)
-            # for Demandware the version directory is slightly different
-            url = re.sub('/v\d+/', '/v9999999999/',url) 
-
-        # check response headers for JavaScript and only process those entries
-        # record hash of content, size, and original (unhashed) content
-        
-        for header in entry['response']['headers']:
-            # print ("Check url: " + url + "Found name: " + header['name'] + "and value: " + header['value'])
-            if header['name'].lower() == 'content-type':
-                if "javascript" in header['value']:
-                    # ok, so we know it's JavaScript, let's record whether
-                    # it's external so we can report if required
-                   
-                    if debug:
-                        print ("Found name: " + header['name'] + "and value: " + header['value'])
-                    if debug:
-                        print ("Javascript Artifact found: " + url)
-                   
-                    if not 'text' in entry['response']['content'].keys():
-                        print ("Anomoly ignored: no text content in " + url)
-                        entry['response']['content']['text'] = "ADDED TEXT TO ANOMOLY"
-                    content_to_hash = entry['response']['content']['text'].encode('utf-8')
-                    m.update(content_to_hash)
-                    if debug:
-                        print ("\tsize: " + str(entry['response']['content']['size']) + " hash: " + m.hexdigest())
-                    # build record for this file URL
-                    JSFiles[url] = {}
-                    JSFiles[url]['size']=entry['response']['content']['size']
-                    JSFiles[url]['hash']=m.hexdigest()
-                    # JSFiles[url]['text']=entry['response']['content']['text']
-                    JSFiles[url]['text']="redacted"
-
-                    # we will look for a referer too
-                    JSFiles[url]['referer']=''
-                    for request_header in entry['request']['headers']:
-                        if request_header['name'].lower() == 'referer':
-                            # print ("Found referer for %s is %s" % (url, request_header['value']))
-                            JSFiles[url]['referer']=re.sub('\?.+$', '[qstring redacted]', request_header['value'])
-                            # print ("Made referer for {0} as {1}".format(url, JSFiles[url]['referer']))
+    title = file_details['title']
+    if title[:8].lower() == 'https://':
+        slash = title.find('/', 8)
+        if slash == -1:
+            slash = len(title)
+        if slash > 8:
+            page_domain = title[:slash]
+            print ("Page domain is " + page_domain)
+
+
+    # the bodies are hashed on a pool of threads while we carry on walking
+    # the entries (BLAKE2 releases the GIL on large inputs), the hashes
+    # are collected into JSFiles once all the entries have been seen
+    pending_hashes = {}
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=hash_workers) as hashing:
+        try:
+            all_entries_array = outerDict['log']['entries']
+            for entry in all_entries_array:
+                # take local references to the parts of the entry we use,
+                # saves repeating the same chain of lookups below
+                request = entry['request']
+                content = entry['response']['content']
+
+                # check response headers for JavaScript and only process those entries,
+                # most entries are images, fonts etc. so find that out before doing
+                # any other work on them
+                content_type = entry['_rh'].get(CONTENT_TYPE, '')
+                if not isJavaScript(content_type):
+                    continue
+
+                url = request['url']
+                # we need to remove the query string from any URL
+                # because they are often extemely long and reduce readability
+                url = redactQstring(url)
+
+                # check for external vs internal domain, with no page domain
+                # (title is not an https URL) everything is treated as external
+                if not page_domain or not url.startswith(page_domain):
+                    # print (url + " is external")
+                    pass
+                else:
+                    # print (url + " is internal")
+                    # we have an internal JS path so ignore the version number
+                    # if this is a Magento system, other content platforms
+                    # can be dealt with in a similar manner but if used 
+                    # regularly we should problem extract this to a config file
+                    url = _VERSION_RE.sub('/version9999999999/', url)
+                    # for Demandware the version directory is slightly different
+                    url = _V_RE.sub('/v9999999999/', url)
+
+                # ok, so we know it's JavaScript, let's record whether
+                # it's external so we can report if required
+                if debug:
+                    print ("Found content-type: " + content_type)
+                if debug:
+                    print ("Javascript Artifact found: " + url)
+
+                # record hash (once it is ready) and size of the content
+                if not 'text' in content:
+                    print ("Anomoly ignored: no text content in " + url)
+                pending_hashes[url] = hashing.submit(hashBody, content)
+                # build record for this file URL
+                # and we will look for a referer too
+                JSFiles[url] = {
+                    'size' : content['size'],
+                    'hash' : None,
+                    'referer' : redactQstring(entry['_qh'].get(REFERER, ''))
+                }
+
+            # now fill in the hashes
+            for url, hash_future in pending_hashes.items():
+                JSFiles[url]['hash'] = hash_future.result()
+                if debug:
+                    print ("\t" + url + " size: " + str(JSFiles[url]['size']) + " hash: " + JSFiles[url]['hash'])
+        except BaseException:
+            # don't leave hashes for a HAR we can't finish running
+            for hash_future in pending_hashes.values():
+                hash_future.cancel()
+            raise
 
-    
     return {'JSFiles' : JSFiles, 'fileDetails' : file_details}
 
 
+# function badHAR will report a .har file that could not be parsed and stop
+
+def badHAR(filename):
+    print("\nThe file %s does not appear to be valid JSON.\nSometimes Chrome doesn't save the .har file properly. \
+        \nSave the file again and retry!" % filename)
+    sys.exit("Could not continue. Stopping.")
+
+
 # function readHAR will read a .har file and parse the contents into a dictonary
+# very large files are streamed instead (see streamHAR)
 
 def readHAR(filename):
-    outer_dict = {}
-   
-    try:
-        with open(filename, 'r', encoding='utf-8') as f:
-            outer_dict = simplejson.load(f)
-    except simplejson.errors.JSONDecodeError:
-        print("\nThe file %s does not appear to be valid JSON.\nSometimes Chrome doesn't save the .har file properly. \
-            \nSave the file again and retry!" % filename)
-        sys.exit("Could not continue. Stopping.")
+    if ijson and os.path.getsize(filename) > stream_threshold:
+        return streamHAR(filename)
+
+    outer_dict = None
+    if orjson:
+        try:
+            with open(filename, 'rb') as f:
+                outer_dict = orjson.loads(f.read())
+        except orjson.JSONDecodeError:
+            # orjson rejects some things simplejson accepts (lone surrogate
+            # escapes, NaN etc.) so try again with simplejson before giving up
+            pass
+
+    if outer_dict is None:
+        try:
+            with open(filename, 'r', encoding='utf-8') as f:
+                outer_dict = simplejson.load(f)
+        except simplejson.errors.JSONDecodeError:
+            badHAR(filename)
+
+    for entry in outer_dict['log']['entries']:
+        indexHeaders(entry)
 
     return outer_dict
 
 
+# function streamHAR will return a dictionary shaped like the one from readHAR
+# but holding only the first page, with 'entries' being a generator which
+# parses the entries from the file as getJS asks for them
+
+def streamHAR(filename):
+    pages = []
+
+    try:
+        with open(filename, 'rb') as f:
+            for page in ijson.items(f, 'log.pages.item'):
+                pages.append(page)
+                break
+    except ijson.JSONError:
+        badHAR(filename)
+
+    return {'log' : {'pages' : pages, 'entries' : streamEntries(filename)}}
+
+
+# function streamEntries will yield the entries of a .har file one at a time
+
+def streamEntries(filename):
+    try:
+        with open(filename, 'rb') as f:
+            for entry in ijson.items(f, 'log.entries.item'):
+                yield indexHeaders(entry)
+    except ijson.JSONError:
+        badHAR(filename)
+
+
 # function compareJS will return a dictionary with the
 # following keys 
 # 'newJS' (a dictionary mapping URLs to '1')
@@ -159,18 +328,25 @@ def readHAR(filename):
 
 def compareJS(baseDict, compDict):
     # make return data structure
-    differences = {'newJS' : {}, 'hashDifferentJS' : {}}
-
-    # first check for new JS files
-    for key in compDict:
-        if not key in baseDict:
-            differences['newJS'][key]=1
+    newJS = {}
+    hashDifferentJS = {}
+    differences = {'newJS' : newJS, 'hashDifferentJS' : hashDifferentJS}
+
+    # one pass over compDict, so the results keep the order the page
+    # loaded the files in, with a single lookup into baseDict per file
+    for key, compRecord in compDict.items():
+        baseRecord = baseDict.get(key)
+        if baseRecord is None:
+            # first check for new JS files
+            newJS[key]=1
         else:
             # not new so there must be a hash in both har files
             # we will compare the hashes
-            if baseDict[key]['hash'] != compDict[key]['hash']:
-                differences['hashDifferentJS'][key] = \
-                    {'baseline' : baseDict[key]['hash'], 'compare' : compDict[key]['hash']}
+            baseHash = baseRecord['hash']
+            compHash = compRecord['hash']
+            if baseHash != compHash:
+                hashDifferentJS[key] = \
+                    {'baseline' : baseHash, 'compare' : compHash}
 
     return differences
 
@@ -189,22 +365,30 @@ def pTitle():
 pTitle()
 
 
-# get the .har file as a dictionary
-print ("Reading baseline HAR...")
-baselineDict = readHAR(sys.argv[1])
-
-
-writeLog("Basline HAR: " + sys.argv[1])
-print ("Reading new HAR...")
-toCompareDict = readHAR(sys.argv[2])
-writeLog("New HAR: " + sys.argv[2])
-
-# parse the dictionaries
+# the two .har files are independent so we read them side by side, file
+# reads release the GIL so one file's I/O overlaps the other's parse
+with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+    # get the .har files as dictionaries
+    print ("Reading baseline and new HARs...")
+    baselineFuture = executor.submit(readHAR, sys.argv[1])
+    compareFuture = executor.submit(readHAR, sys.argv[2])
+    baselineDict = baselineFuture.result()
+    writeLog("Basline HAR: " + sys.argv[1])
+    toCompareDict = compareFuture.result()
+    writeLog("New HAR: " + sys.argv[2])
+
+# parse the dictionaries one at a time, so anything getJS prints
+# is clearly about one file (the hashing inside is already parallel)
 print ("Parsing baseline HAR...")
 baselineFilesFoundDetails = getJS(baselineDict,debug)
 print ("Parsing new HAR...")
 compareFilesFoundDetails = getJS(toCompareDict,debug)
 
+# we only need the JavaScript details from now on so let the
+# (possibly very large) parsed HAR files go, the read futures
+# still hold on to them as their results so they must go too
+del baselineDict, toCompareDict, baselineFuture, compareFuture
+
 # isolate just he JavaScript information ready for comparison
 baselineFilesFound = baselineFilesFoundDetails['JSFiles']
 compareFilesFound = compareFilesFoundDetails['JSFiles']
@@ -235,7 +419,7 @@ print ("")
 
 summary_log_string += baselineFilesFoundDetails['fileDetails']['title'] + ", " + sys.argv[1] \
     + ", " + sys.argv[2] + ", "
-if not bool(foundDifferences['newJS']) and not bool(foundDifferences['hashDifferentJS']):
+if not foundDifferences['newJS'] and not foundDifferences['hashDifferentJS']:
     print (GREEN)
     print (u'\u221A' + RESET + " All clear - no changes found")
     writeLog(" All clear - no changes found")
@@ -247,13 +431,13 @@ else:
     summary_log_string += "CHANGES"
 print("")
 
-if not bool(foundDifferences['newJS']):
+if not foundDifferences['newJS']:
     print ("No new JS files found")
     writeLog("No new JS files found")
 else:
     print (str(len(foundDifferences['newJS'])) + " new JavaScript files found")
     writeLog(" new JavaScript files found")
-    for JSfilename in foundDifferences['newJS'].keys():
+    for JSfilename in foundDifferences['newJS']:
         print ("\t" + JSfilename, end='')
         if compareFilesFound[JSfilename]['referer'] != '':
             print (" [Referer:{0}]".format(compareFilesFound[JSfilename]['referer']))
@@ -261,13 +445,13 @@ else:
             print("\n")
         writeLog(JSfilename)
 
-if not bool(foundDifferences['hashDifferentJS']):
+if not foundDifferences['hashDifferentJS']:
     print ("No changes in JS found")
     writeLog("No changes in JS found")
 else:
     print (str(len(foundDifferences['hashDifferentJS'])) + " changed JavaScript files found")
     writeLog(" changed JavaScript files found")
-    for JSfilename in foundDifferences['hashDifferentJS'].keys():
+    for JSfilename in foundDifferences['hashDifferentJS']:
         print ("\t" + JSfilename, end='')
         if compareFilesFound[JSfilename]['referer'] != '':
             print (" [Referer:{0}]".format(compareFilesFound[JSfilename]['referer']))
@@ -279,16 +463,14 @@ else:
             + foundDifferences['hashDifferentJS'][JSfilename]['compare']
         )
 
-# write the detailed logfile
-my_logfile = open(log_filename, "a+")
-for line in log_lines:
-    my_logfile.write(line + "\n")
-my_logfile.close()
+# write the detailed logfile, all lines in a single write
+# with the timestamp added to the start of each line
+with open(log_filename, "a+") as my_logfile:
+    my_logfile.write("".join(log_timestamp + line + "\n" for line in log_lines))
 
 # write the summary logfile
-my_summary_logfile = open(summary_filename, "a+")
-my_summary_logfile.write(summary_log_string + "\n")
-my_summary_logfile.close()
+with open(summary_filename, "a+") as my_summary_logfile:
+    my_summary_logfile.write(summary_log_string + "\n")
 
 
 exit